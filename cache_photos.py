@@ -0,0 +1,156 @@
+"""Офлайн-подготовка фото мест для бота.
+
+Скачивает каждую картинку из колонки photo один раз, проверяет, что она
+декодируется, пережимает в JPEG ограниченного размера и кладёт в
+photo_cache/<sha256>.jpg. Результат — photo_cache/manifest.json
+(url → файл или ошибка) и колонка photo_status в каталоге (ok / broken).
+
+Нужен Pillow: pip install Pillow
+"""
+import os
+import io
+import json
+import hashlib
+import time
+import requests
+import pandas as pd
+from PIL import Image, ImageOps
+
+BASE_DIR = os.path.dirname(__file__)
+CSV_FILE = os.path.join(BASE_DIR, "places_semicolon_fixed.csv")
+CACHE_DIR = os.path.join(BASE_DIR, "photo_cache")
+MANIFEST_FILE = os.path.join(CACHE_DIR, "manifest.json")
+
+HEADERS = {"User-Agent": "AI Travel Crimea Bot/1.0 (https://t.me/yourbot)"}
+
+MAX_DOWNLOAD = 25 * 1024 * 1024   # больше не качаем
+MAX_SIDE = 1280                   # px, длинная сторона
+MAX_BYTES = 500 * 1024            # целевой размер JPEG
+QUALITIES = (85, 75, 65, 55)
+SAVE_EVERY = 10                   # сохранять манифест каждые N новых записей
+
+def download(url: str) -> bytes:
+    with requests.get(url, headers=HEADERS, timeout=20, stream=True) as res:
+        res.raise_for_status()
+        buf = io.BytesIO()
+        for chunk in res.iter_content(64 * 1024):
+            buf.write(chunk)
+            if buf.tell() > MAX_DOWNLOAD:
+                raise ValueError("файл слишком большой")
+    return buf.getvalue()
+
+def flatten(img):
+    """Прозрачность (RGBA/LA/P с tRNS) кладём на белый фон, а не в чёрный."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        bg = Image.new("RGB", rgba.size, (255, 255, 255))
+        bg.paste(rgba, mask=rgba.getchannel("A"))
+        return bg
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+def to_jpeg(raw: bytes):
+    """Декодирует картинку и пережимает в JPEG не больше MAX_SIDE/MAX_BYTES."""
+    img = Image.open(io.BytesIO(raw))
+    img.load()
+    # EXIF при пережатии теряется — поворот применяем к пикселям заранее
+    img = ImageOps.exif_transpose(img)
+    img = flatten(img)
+    img.thumbnail((MAX_SIDE, MAX_SIDE))
+    for q in QUALITIES:
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=q, optimize=True, progressive=True)
+        data = out.getvalue()
+        if len(data) <= MAX_BYTES:
+            break
+    return data, img.size
+
+def load_manifest() -> dict:
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(manifest: dict):
+    tmp = MANIFEST_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp, MANIFEST_FILE)
+
+def save_catalogue(df):
+    """Атомарно: бот перечитывает CSV по mtime и не должен увидеть его наполовину."""
+    tmp = CSV_FILE + ".tmp"
+    df.to_csv(tmp, sep=";", encoding="utf-8-sig", index=False)
+    os.replace(tmp, CSV_FILE)
+
+def process(url: str) -> dict:
+    try:
+        data, (w, h) = to_jpeg(download(url))
+    except Exception as e:
+        return {"ok": False, "error": str(e)[:200]}
+    digest = hashlib.sha256(data).hexdigest()
+    name = f"{digest}.jpg"
+    path = os.path.join(CACHE_DIR, name)
+    # Недописанный файл от прерванного запуска узнаём по размеру и перезаписываем
+    if not os.path.exists(path) or os.path.getsize(path) != len(data):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return {"ok": True, "file": name, "width": w, "height": h, "bytes": len(data)}
+
+def main():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    manifest = load_manifest()
+
+    df = pd.read_csv(CSV_FILE, sep=";", encoding="utf-8-sig")
+    if "photo" not in df.columns:
+        df["photo"] = ""
+
+    statuses = []
+    unsaved = 0
+    checked = set()  # URL, уже скачанные в этом запуске (в т.ч. неудачно)
+    try:
+        for _, row in df.iterrows():
+            url = str(row.get("photo", "")).strip()
+            if not url.startswith("http"):
+                statuses.append("")
+                continue
+
+            entry = manifest.get(url)
+            cached = url in checked or (
+                entry and entry.get("ok") and os.path.exists(os.path.join(CACHE_DIR, entry["file"]))
+            )
+            if not cached:
+                print(f"⬇️ {row['name']}: {url}")
+                prev, entry = entry, process(url)
+                checked.add(url)
+                if entry != prev:
+                    manifest[url] = entry
+                    unsaved += 1
+                    if unsaved >= SAVE_EVERY:
+                        save_manifest(manifest)
+                        unsaved = 0
+                if entry["ok"]:
+                    print(f"✅ {entry['file']} ({entry['width']}x{entry['height']}, {entry['bytes'] // 1024} КБ)")
+                else:
+                    print(f"❌ Битая ссылка: {entry['error']}")
+                time.sleep(0.5)
+            statuses.append("ok" if entry["ok"] else "broken")
+    finally:
+        # Прерванный запуск не теряет уже скачанное; лишняя запись = лишняя перезагрузка в боте
+        if unsaved:
+            save_manifest(manifest)
+            print(f"\n💾 Манифест: {MANIFEST_FILE}")
+    old = df["photo_status"].fillna("").astype(str).tolist() if "photo_status" in df.columns else None
+    if old != statuses:
+        df["photo_status"] = statuses
+        save_catalogue(df)
+        print(f"💾 Статусы фото обновлены: {CSV_FILE}")
+
+    broken = statuses.count("broken")
+    print(f"📊 Готово: {statuses.count('ok')} ок, {broken} битых")
+
+if __name__ == "__main__":
+    main()
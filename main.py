@@ -1,13 +1,17 @@
 import os
+import json
 import math
 import logging
 import pandas as pd
 import asyncio
 import aiohttp
+from pathlib import Path
+from types import MappingProxyType
 from typing import List, Dict, Tuple
 from urllib.parse import quote_plus
 import re
 import numpy as np
+from collections import defaultdict
 from datetime import datetime, date
 
 from telegram import (
@@ -17,8 +21,10 @@ from telegram import (
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
@@ -39,6 +45,9 @@ ASK_CITY, ASK_INTERESTS, ASK_CAR = range(3)
 # ============== Data & Config =================
 BASE_DIR = os.path.dirname(__file__)
 CSV_PATH = os.path.join(BASE_DIR, "places_semicolon_fixed.csv")
+# Готовит cache_photos.py
+PHOTO_CACHE_DIR = os.path.join(BASE_DIR, "photo_cache")
+PHOTO_MANIFEST = os.path.join(PHOTO_CACHE_DIR, "manifest.json")
 
 def parse_rating(v):
     """Устойчивый парсер рейтинга: 4,8 / 4.75 / '4,7 из 5' / '04.07.2024' → 4.7 и т.д."""
@@ -91,12 +100,16 @@ def parse_rating(v):
         return np.nan
 
 
-df = pd.read_csv(
-    CSV_PATH,
-    sep=";",
-    encoding="utf-8-sig",
-    converters={"rating": parse_rating}
-)
+def load_places():
+    return pd.read_csv(
+        CSV_PATH,
+        sep=";",
+        encoding="utf-8-sig",
+        converters={"rating": parse_rating}
+    )
+
+
+df = load_places()
 
 
 # ============== Interests =====================
@@ -298,15 +311,42 @@ async def get_weather(city):
                 pass
     return line
 
-# ================== UI ===================
-def restart_kb():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Начать заново", callback_data="restart")]])
+# ================== Render cache ===================
+# Экстренные кнопки: тег → (иконка, база, текст при пустой базе)
+EMERGENCY = {
+    "туалеты": ("🚻", TOILETS, "🚻 Нет данных для этого города."),
+    "медицина": ("🏥", MEDHELP, None),
+    "полиция": ("👮", POLICE, None),
+}
 
-def interests_kb(selected, city):
-    items = INTERESTS if city in COASTAL_CITIES else [i for i in INTERESTS if i[0] != "море"]
+# Переключаемые интересы — их выбор кодируется битовой маской
+TOGGLE_TAGS = [key for key, _ in INTERESTS if key not in EMERGENCY]
+TAG_BITS = {key: 1 << i for i, key in enumerate(TOGGLE_TAGS)}
+
+def yandex_link(text) -> str:
+    return f"https://yandex.ru/maps/?text={quote_plus(str(text))}"
+
+def tags_mask(selected) -> int:
+    mask = 0
+    for tag in selected:
+        mask |= TAG_BITS.get(tag, 0)
+    return mask
+
+def render_caption(row) -> str:
+    yandex = yandex_link(f"{row['name']} {row['city']}")
+    rating_val = row.get("rating")
+    rating_val = 4.5 if pd.isna(rating_val) else float(rating_val)
+    return (
+        f"*{row['name']}* — {row['city']}\n"
+        f"⭐ {rating_val:.1f} | _{row['tags']}_\n"
+        f"[Открыть в Яндекс.Картах]({yandex})"
+    )
+
+def build_interests_kb(mask, coastal):
+    items = INTERESTS if coastal else [i for i in INTERESTS if i[0] != "море"]
     rows, row = [], []
     for key, label in items:
-        mark = "✅ " if key in selected else ""
+        mark = "✅ " if mask & TAG_BITS.get(key, 0) else ""
         row.append(InlineKeyboardButton(mark + label, callback_data=f"tag:{key}"))
         if len(row) == 2:
             rows.append(row)
@@ -319,12 +359,316 @@ def interests_kb(selected, city):
     ])
     return InlineKeyboardMarkup(rows)
 
+def load_photo_manifest() -> dict:
+    try:
+        with open(PHOTO_MANIFEST, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Манифест фото не прочитан: {e}")
+        return {}
+
+def resolve_photo(row, manifest):
+    """Локальный файл из кэша, None для битых ссылок, иначе исходный URL."""
+    photo = str(row.get("photo", "")).strip()
+    if not photo.startswith("http"):
+        return None
+    if str(row.get("photo_status", "")).strip() == "broken":
+        return None
+    entry = manifest.get(photo)
+    if entry:
+        if not entry.get("ok"):
+            return None
+        path = Path(PHOTO_CACHE_DIR) / entry["file"]
+        if path.exists():
+            return path
+    return photo
+
+def catalogue_version():
+    def mtime(path):
+        return os.path.getmtime(path) if os.path.exists(path) else None
+    return (mtime(CSV_PATH), mtime(PHOTO_MANIFEST))
+
+def build_static_render():
+    """Клавиатуры и экстренные списки — от каталога не зависят, собираются один раз.
+
+    Объекты Telegram (клавиатуры) после создания неизменяемы, остальное
+    хранится в кортежах и MappingProxyType — хендлеры отдают их как есть.
+    """
+    emergency = {}
+    for tag, (icon, base, _) in EMERGENCY.items():
+        for city, items in base.items():
+            emergency[(tag, city)] = tuple(
+                f"{icon} {t['name']}\n{t['address']}\n[Открыть в Яндекс.Картах]({yandex_link(t['address'])})"
+                for t in items
+            )
+
+    interests = {
+        (coastal, mask): build_interests_kb(mask, coastal)
+        for coastal in (False, True)
+        for mask in range(1 << len(TOGGLE_TAGS))
+    }
+
+    return {
+        "emergency": MappingProxyType(emergency),
+        "interests": MappingProxyType(interests),
+        "city_kb": ReplyKeyboardMarkup([[KeyboardButton(c)] for c in CITIES_PRESETS], resize_keyboard=True),
+        "restart_kb": InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Начать заново", callback_data="restart")]]),
+        "car_kb": InlineKeyboardMarkup([
+            [InlineKeyboardButton("🚗 Да", callback_data="car_yes")],
+            [InlineKeyboardButton("🚶 Нет", callback_data="car_no")],
+            [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
+        ]),
+    }
+
+STATIC_RENDER = build_static_render()
+
+def build_render_cache(places):
+    """Карточки мест на версию каталога плюс общие статичные ответы."""
+    manifest = load_photo_manifest()
+    cards = {}
+    for idx, r in places.iterrows():
+        cards[idx] = (render_caption(r), resolve_photo(r, manifest))
+    return MappingProxyType({**STATIC_RENDER, "cards": MappingProxyType(cards)})
+
+def load_catalogue():
+    version = catalogue_version()
+    places = load_places()
+    return places, build_render_cache(places), version
+
+RENDER = build_render_cache(df)
+CATALOGUE_VERSION = catalogue_version()
+
+# Загруженные в Telegram локальные фото: путь → file_id (файлы адресованы по содержимому)
+PHOTO_FILE_IDS: Dict[Path, str] = {}
+
+_reload_lock = asyncio.Lock()
+
+async def reload_data():
+    """Перечитывает каталог в отдельном потоке и подменяет кэш ответов одним шагом."""
+    global df, RENDER, CATALOGUE_VERSION
+    places, render, version = await asyncio.to_thread(load_catalogue)
+    df, RENDER, CATALOGUE_VERSION = places, render, version
+    logger.info(f"Каталог перечитан: {len(df)} мест")
+
+async def reload_if_changed():
+    """Дешёвая проверка mtime CSV и манифеста фото — кэш сбрасывается только при их изменении.
+
+    Если перезагрузка уже идёт, не ждём её и отвечаем по текущей версии.
+    """
+    if _reload_lock.locked():
+        return
+    async with _reload_lock:
+        try:
+            if catalogue_version() != CATALOGUE_VERSION:
+                await reload_data()
+        except Exception as e:
+            logger.warning(f"Не удалось перечитать каталог: {e}")
+
+# ================== UI ===================
+def restart_kb():
+    return RENDER["restart_kb"]
+
+def interests_kb(selected, city):
+    return RENDER["interests"][(city in COASTAL_CITIES, tags_mask(selected))]
+
+def selected_text(selected):
+    chosen = [key for key, _ in INTERESTS if key in selected]
+    return f"Выбрано: {', '.join(chosen) if chosen else 'ничего'}"
+
+# ================== Coalesced edits ===================
+EDIT_DEBOUNCE = 0.4  # сек. — быстрые нажатия склеиваются в одно редактирование
+
+def schedule_interests_edit(query, context):
+    """Откладывает редактирование сообщения с интересами: за окно debounce
+    уходит только последнее состояние, одинаковое содержимое не отправляется."""
+    city = context.user_data.get("city", "")
+    tags = context.user_data.get("tags", set())
+    content = (selected_text(tags), city in COASTAL_CITIES, tags_mask(tags))
+    msg_id = query.message.message_id
+
+    state = context.user_data.get("edit")
+    if state is None or state["message_id"] != msg_id:
+        cancel_interests_edit(context)
+        state = {"message_id": msg_id, "content": None, "sent": None, "task": None}
+        context.user_data["edit"] = state
+    state["content"] = content
+    if state["task"] is None:
+        state["task"] = context.application.create_task(flush_interests_edit(query, state))
+
+async def flush_interests_edit(query, state):
+    while True:
+        await asyncio.sleep(EDIT_DEBOUNCE)
+        content = state["content"]
+        if content != state["sent"]:
+            text, coastal, mask = content
+            try:
+                await query.edit_message_text(text, reply_markup=RENDER["interests"][(coastal, mask)])
+                state["sent"] = content
+            except RetryAfter as e:
+                # флуд-лимит: ждём и отправляем уже самое свежее состояние
+                await asyncio.sleep(e.retry_after)
+                continue
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    state["sent"] = content
+                else:
+                    logger.warning(f"Ошибка при редактировании интересов: {e}")
+            except Exception as e:
+                logger.warning(f"Ошибка при редактировании интересов: {e}")
+        # пока шёл запрос, могли нажать ещё — тогда ещё один круг
+        if state["content"] == content:
+            break
+    state["task"] = None
+
+def cancel_interests_edit(context):
+    state = context.user_data.pop("edit", None)
+    if state and state["task"] is not None:
+        state["task"].cancel()
+
+# ================== Scheduler ===================
+# Классы приоритета: меньше — раньше
+PRIO_EMERGENCY, PRIO_INTERACTIVE, PRIO_RECOMMEND = range(3)
+
+SCHED_WORKERS = 8        # одновременно обрабатываемых апдейтов
+SCHED_PER_CHAT = 1       # одновременно на один чат (ConversationHandler не любит гонок)
+SCHED_SHED_DEPTH = 40    # глубина очереди, после которой отказываем всем, кроме экстренных
+BUSY_TEXT = "😅 Сейчас очень много запросов, попробуйте через минуту."
+
+def update_priority(update) -> int:
+    query = update.callback_query if isinstance(update, Update) else None
+    if query is None:
+        return PRIO_INTERACTIVE
+    data = query.data or ""
+    if data.startswith("tag:") and data.split(":", 1)[1] in EMERGENCY:
+        return PRIO_EMERGENCY
+    if data in ("car_yes", "car_no"):
+        return PRIO_RECOMMEND
+    return PRIO_INTERACTIVE
+
+def update_dedup_key(update):
+    """Ключ для склейки повторов; переключения интересов не склеиваются —
+    двойное нажатие там означает «включить и выключить»."""
+    if not isinstance(update, Update) or update.effective_chat is None:
+        return None
+    chat_id = update.effective_chat.id
+    query = update.callback_query
+    if query is not None:
+        data = query.data or ""
+        if data.startswith("tag:") and data.split(":", 1)[1] not in EMERGENCY:
+            return None
+        return (chat_id, "cb", data)
+    if update.message is not None:
+        return (chat_id, "msg", update.message.text)
+    return None
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Очередь апдейтов с приоритетами вместо FIFO.
+
+    Один воркер всегда держится свободным для экстренных запросов, повторы
+    из того же чата отбрасываются, а при переполнении очереди пользователю
+    сразу отвечаем «попробуйте через минуту».
+    """
+
+    def __init__(self, workers=SCHED_WORKERS, per_chat=SCHED_PER_CHAT, shed_depth=SCHED_SHED_DEPTH):
+        # Базовый семафор только страхует от бесконечного роста — очередью управляем сами
+        super().__init__(max_concurrent_updates=workers + shed_depth + 256)
+        self.workers = max(2, workers)
+        self.per_chat = per_chat
+        self.shed_depth = shed_depth
+        self._running = 0
+        self._running_by_chat = defaultdict(int)
+        self._waiting = []  # (priority, seq, chat_id, future)
+        self._seq = 0
+        self._inflight = set()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        for *_, fut in self._waiting:
+            fut.cancel()
+        self._waiting.clear()
+
+    def _dispatch(self):
+        for item in sorted(self._waiting):
+            priority, _, chat_id, fut = item
+            limit = self.workers if priority == PRIO_EMERGENCY else self.workers - 1
+            if self._running >= limit:
+                continue
+            if chat_id is not None and self._running_by_chat[chat_id] >= self.per_chat:
+                continue
+            self._waiting.remove(item)
+            self._running += 1
+            if chat_id is not None:
+                self._running_by_chat[chat_id] += 1
+            fut.set_result(None)
+
+    def _release(self, chat_id):
+        self._running -= 1
+        if chat_id is not None:
+            self._running_by_chat[chat_id] -= 1
+            if not self._running_by_chat[chat_id]:
+                del self._running_by_chat[chat_id]
+        self._dispatch()
+
+    async def _acquire(self, priority, chat_id):
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        item = (priority, self._seq, chat_id, fut)
+        self._waiting.append(item)
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if item in self._waiting:
+                self._waiting.remove(item)
+            elif fut.done() and not fut.cancelled():
+                self._release(chat_id)
+            raise
+
+    async def _reject(self, update, text=None):
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(text, show_alert=bool(text))
+            elif text and update.message is not None:
+                await update.message.reply_text(text)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить на отклонённый апдейт: {e}")
+
+    async def do_process_update(self, update, coroutine) -> None:
+        priority = update_priority(update)
+        key = update_dedup_key(update)
+        chat_id = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+
+        if key is not None and key in self._inflight:
+            coroutine.close()
+            await self._reject(update)
+            return
+        if priority != PRIO_EMERGENCY and len(self._waiting) >= self.shed_depth:
+            coroutine.close()
+            logger.warning(f"Очередь переполнена ({len(self._waiting)}), апдейт отклонён")
+            await self._reject(update, BUSY_TEXT)
+            return
+
+        if key is not None:
+            self._inflight.add(key)
+        try:
+            await self._acquire(priority, chat_id)
+            try:
+                await coroutine
+            finally:
+                self._release(chat_id)
+        finally:
+            coroutine.close()
+            self._inflight.discard(key)
+
 # ================== Bot Flow ===================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    kb = [[KeyboardButton(c)] for c in CITIES_PRESETS]
     await update.message.reply_text(
     "Привет! 🚀\nЯ — AI Travel Crimea, твой карманный помощник в поездке по Крыму 🏝\n\nВыбери город, чтобы показать лучшие места и полезные локации поблизости 🌆",
-    reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
+    reply_markup=RENDER["city_kb"]
 )
 
     return ASK_CITY
@@ -337,13 +681,14 @@ async def ask_interests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["city"] = city
     context.user_data["origin"] = CITIES_PRESETS[city]
     context.user_data["tags"] = set()
+    cancel_interests_edit(context)
     await update.message.reply_text(f"Отлично, {city}! Выбери интересы:", reply_markup=interests_kb(set(), city))
     return ASK_INTERESTS
 
 async def handle_restart(query, context):
     await query.message.reply_text(
         "🔁 Начнём заново! Выбери город:",
-        reply_markup=ReplyKeyboardMarkup([[KeyboardButton(c)] for c in CITIES_PRESETS], resize_keyboard=True),
+        reply_markup=RENDER["city_kb"],
     )
     return ASK_CITY  # важное: остаёмся в разговоре и ждём город
 
@@ -355,45 +700,23 @@ async def interests_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     tags = context.user_data.get("tags", set())
 
     if data == "restart":
+        cancel_interests_edit(context)
         return await handle_restart(query, context)
     if data == "back_city":
+        cancel_interests_edit(context)
         return await handle_restart(query, context)
 
     if data.startswith("tag:"):
         tag = data.split(":", 1)[1]
 
         # 🚻 / 🏥 / 👮
-        if tag == "туалеты":
-            toilets = TOILETS.get(city, [])
-            if not toilets:
-                await query.message.reply_text("🚻 Нет данных для этого города.")
-            else:
-                for t in toilets:
-                    link = f"https://yandex.ru/maps/?text={quote_plus(t['address'])}"
-                    await query.message.reply_text(
-                        f"🚻 {t['name']}\n{t['address']}\n[Открыть в Яндекс.Картах]({link})",
-                        parse_mode="Markdown", disable_web_page_preview=True
-                    )
-            await query.message.reply_text("Хочешь начать заново?", reply_markup=restart_kb())
-            return ASK_INTERESTS
-
-        if tag == "медицина":
-            for t in MEDHELP.get(city, []):
-                link = f"https://yandex.ru/maps/?text={quote_plus(t['address'])}"
-                await query.message.reply_text(
-                    f"🏥 {t['name']}\n{t['address']}\n[Открыть в Яндекс.Картах]({link})",
-                    parse_mode="Markdown", disable_web_page_preview=True
-                )
-            await query.message.reply_text("Хочешь начать заново?", reply_markup=restart_kb())
-            return ASK_INTERESTS
-
-        if tag == "полиция":
-            for t in POLICE.get(city, []):
-                link = f"https://yandex.ru/maps/?text={quote_plus(t['address'])}"
-                await query.message.reply_text(
-                    f"👮 {t['name']}\n{t['address']}\n[Открыть в Яндекс.Картах]({link})",
-                    parse_mode="Markdown", disable_web_page_preview=True
-                )
+        if tag in EMERGENCY:
+            texts = RENDER["emergency"].get((tag, city), ())
+            empty_text = EMERGENCY[tag][2]
+            if not texts and empty_text:
+                await query.message.reply_text(empty_text)
+            for text in texts:
+                await query.message.reply_text(text, parse_mode="Markdown", disable_web_page_preview=True)
             await query.message.reply_text("Хочешь начать заново?", reply_markup=restart_kb())
             return ASK_INTERESTS
 
@@ -403,22 +726,15 @@ async def interests_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         else:
             tags.add(tag)
         context.user_data["tags"] = tags
-        await query.edit_message_text(
-            f"Выбрано: {', '.join(tags) if tags else 'ничего'}",
-            reply_markup=interests_kb(tags, city)
-        )
+        schedule_interests_edit(query, context)
         return ASK_INTERESTS
 
     if data == "done":
         if not tags:
             await query.answer("Выбери хотя бы один интерес 🙂", show_alert=True)
             return ASK_INTERESTS
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🚗 Да", callback_data="car_yes")],
-            [InlineKeyboardButton("🚶 Нет", callback_data="car_no")],
-            [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-        ])
-        await query.edit_message_text("Есть автомобиль?", reply_markup=kb)
+        cancel_interests_edit(context)
+        await query.edit_message_text("Есть автомобиль?", reply_markup=RENDER["car_kb"])
         return ASK_CAR
 
 async def car_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -430,10 +746,12 @@ async def car_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     has_car = query.data == "car_yes"
 
     await query.edit_message_text("⏳ Загружаю погоду и места...")
+    await reload_if_changed()
+    render, places = RENDER, df  # одна версия каталога на весь ответ
     weather = await get_weather(city)
     await query.message.reply_text(weather, parse_mode="Markdown")
 
-    df_city = df[df["city"].astype(str).str.lower() == city.lower()].copy()
+    df_city = places[places["city"].astype(str).str.lower() == city.lower()].copy()
     if df_city.empty:
         await query.message.reply_text("Нет данных по этому городу.")
         return await handle_restart(query, context)
@@ -443,23 +761,15 @@ async def car_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     top = df_city.sort_values("score", ascending=False).head(5)
 
     # === Вывод карточек мест ===
-    for _, r in top.iterrows():
-        query_text = f"{r['name']} {r['city']}"
-        yandex = f"https://yandex.ru/maps/?text={quote_plus(query_text)}"
-
-        rating_val = r.get("rating")
-        rating_val = 4.5 if pd.isna(rating_val) else float(rating_val)
-
-        caption = (
-            f"*{r['name']}* — {r['city']}\n"
-            f"⭐ {rating_val:.1f} | _{r['tags']}_\n"
-            f"[Открыть в Яндекс.Картах]({yandex})"
-        )
-
-        photo = str(r.get("photo", "")).strip()
-        if photo.startswith("http"):
+    for idx in top.index:
+        caption, photo = render["cards"][idx]
+        if photo:
             try:
-                await query.message.reply_photo(photo=photo, caption=caption, parse_mode="Markdown")
+                msg = await query.message.reply_photo(
+                    photo=PHOTO_FILE_IDS.get(photo, photo), caption=caption, parse_mode="Markdown"
+                )
+                if isinstance(photo, Path) and msg.photo:
+                    PHOTO_FILE_IDS[photo] = msg.photo[-1].file_id
             except Exception as e:
                 logger.warning(f"Ошибка при отправке фото: {e}")
                 await query.message.reply_text(caption, parse_mode="Markdown", disable_web_page_preview=True)
@@ -476,7 +786,7 @@ import asyncio
 
 async def main():
     token = os.getenv("BOT_TOKEN")
-    app = ApplicationBuilder().token(token).build()
+    app = ApplicationBuilder().token(token).concurrent_updates(PriorityUpdateProcessor()).build()
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],